@@ -1,11 +1,28 @@
-from fastapi import FastAPI
+import os
+
+# PyTorch reads its allocator config when CUDA is first initialised, so set it
+# before ultralytics/torch are imported
+os.environ.setdefault(
+    "PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True,max_split_size_mb:128"
+)
+
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
 from ultralytics import YOLO
+from ultralytics.utils import ops
+import asyncio
 import cv2
 import numpy as np
-import base64
-import os
+import hashlib
+import ipaddress
+import pybase64
+import shutil
+import tempfile
+import torch
+import yaml
 
 app = FastAPI()
 
@@ -37,17 +54,387 @@ DEFAULT_MODEL_PATH = os.path.join(
 )
 MODEL_PATH = os.getenv("MODEL_PATH", DEFAULT_MODEL_PATH)
 
+# Micro-batching: requests arriving within BATCH_WINDOW_MS of each other are
+# coalesced into a single batched forward pass (up to MAX_BATCH_SIZE images)
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "8"))
+BATCH_WINDOW_S = float(os.getenv("BATCH_WINDOW_MS", "5")) / 1000.0
+
+# Optional TensorRT engine (requires a CUDA GPU and the tensorrt package).
+# Engines are GPU-specific, so they are cached on disk keyed by weights hash + SM.
+USE_TENSORRT = os.getenv("USE_TENSORRT", "0") == "1"
+ENGINE_CACHE_DIR = os.getenv("ENGINE_CACHE_DIR", os.path.join(BASE_DIR, "engines"))
+# "fp16" or "int8"; INT8 is calibrated on the images listed in INT8_CALIB_DATA
+TENSORRT_PRECISION = os.getenv("TENSORRT_PRECISION", "fp16").lower()
+INT8_CALIB_DATA = os.getenv(
+    "INT8_CALIB_DATA", os.path.join(BASE_DIR, "yolo", "splits", "dataset.yaml")
+)
+IMGSZ = 640
+
+# torch.compile (mode="reduce-overhead") removes per-call launch overhead; on by
+# default when a CUDA GPU is available
+USE_TORCH_COMPILE = (
+    os.getenv("USE_TORCH_COMPILE", "1" if torch.cuda.is_available() else "0") == "1"
+)
+
+
+def engine_cache_path(weights_path: str) -> str:
+    with open(weights_path, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()[:16]
+    major, minor = torch.cuda.get_device_capability()
+    stem = os.path.splitext(os.path.basename(weights_path))[0]
+    name = f"{stem}-{digest}-sm{major}{minor}-b{MAX_BATCH_SIZE}-{TENSORRT_PRECISION}.engine"
+    return os.path.join(ENGINE_CACHE_DIR, name)
+
+
+def check_calibration_data(data_yaml: str):
+    """
+    Fail early with a clear error if the INT8 calibration dataset, its split
+    files, or the first image each split lists are missing on this host
+    """
+    if not os.path.exists(data_yaml):
+        raise FileNotFoundError(
+            f"INT8 calibration data not found: {data_yaml} (set INT8_CALIB_DATA)"
+        )
+    with open(data_yaml, "r", encoding="utf-8") as f:
+        cfg = yaml.safe_load(f) or {}
+    yaml_dir = os.path.dirname(os.path.abspath(data_yaml))
+    root = os.path.join(yaml_dir, cfg.get("path") or "")
+
+    for key in ("train", "val"):
+        entries = cfg.get(key) or []
+        for entry in entries if isinstance(entries, list) else [entries]:
+            split_path = os.path.join(root, entry)
+            if not os.path.exists(split_path):
+                raise FileNotFoundError(
+                    f"INT8 calibration {key} split not found: {split_path} "
+                    f"(listed in {data_yaml}; regenerate it with yolo/train.py)"
+                )
+            if os.path.isfile(split_path):
+                with open(split_path, "r", encoding="utf-8") as f:
+                    first = f.readline().strip()
+                first_path = os.path.join(os.path.dirname(split_path), first)
+                if first and not os.path.exists(first_path):
+                    raise FileNotFoundError(
+                        f"INT8 calibration image not found: {first_path} "
+                        f"(listed in {split_path}; regenerate it with yolo/train.py)"
+                    )
+
+
+def load_model(weights_path: str) -> YOLO:
+    if not (
+        USE_TENSORRT and weights_path.endswith(".pt") and torch.cuda.is_available()
+    ):
+        return YOLO(weights_path)
+
+    if TENSORRT_PRECISION == "int8":
+        precision_args = {"int8": True, "data": INT8_CALIB_DATA}
+    elif TENSORRT_PRECISION == "fp16":
+        precision_args = {"half": True}
+    else:
+        raise ValueError(f"Unsupported TENSORRT_PRECISION: {TENSORRT_PRECISION}")
+
+    engine_path = engine_cache_path(weights_path)
+    if not os.path.exists(engine_path):
+        if TENSORRT_PRECISION == "int8":
+            check_calibration_data(INT8_CALIB_DATA)
+        print(
+            f"🔧 Exporting TensorRT {TENSORRT_PRECISION.upper()} engine (first run only)..."
+        )
+        os.makedirs(ENGINE_CACHE_DIR, exist_ok=True)
+        # Export from a scratch copy so the intermediate .onnx and .engine are
+        # written under ENGINE_CACHE_DIR, not next to the tracked weights
+        with tempfile.TemporaryDirectory(dir=ENGINE_CACHE_DIR) as scratch:
+            scratch_weights = shutil.copy(weights_path, scratch)
+            exported = YOLO(scratch_weights).export(
+                format="engine",
+                imgsz=IMGSZ,
+                dynamic=True,
+                batch=MAX_BATCH_SIZE,
+                **precision_args,
+            )
+            shutil.move(exported, engine_path)
+    print(f"   TensorRT engine: {engine_path}")
+    return YOLO(engine_path, task="detect")
+
+
+DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+# Reusable host staging buffer for letterboxed frames (NHWC uint8, BGR). Pinned
+# memory makes the host-to-device copy asynchronous. Only the inference thread
+# touches it, one batch at a time.
+staging = torch.empty(
+    (MAX_BATCH_SIZE, IMGSZ, IMGSZ, 3),
+    dtype=torch.uint8,
+    pin_memory=torch.cuda.is_available(),
+)
+staging_np = staging.numpy()
+
+
+def letterbox_into(img: np.ndarray, out: np.ndarray):
+    """Resize img to fit IMGSZ x IMGSZ (keeping aspect ratio) and pad into out"""
+    h, w = img.shape[:2]
+    scale = min(IMGSZ / h, IMGSZ / w)
+    # Clamp so extreme aspect ratios (e.g. 1x2000) don't round a side to 0
+    nh, nw = max(1, round(h * scale)), max(1, round(w * scale))
+    top, left = (IMGSZ - nh) // 2, (IMGSZ - nw) // 2
+    if (nh, nw) != (h, w):
+        img = cv2.resize(img, (nw, nh), interpolation=cv2.INTER_LINEAR)
+    out.fill(114)
+    out[top : top + nh, left : left + nw] = img
+
+
+def staged_batch(n: int) -> torch.Tensor:
+    """Copy the first n letterboxed frames to the device and normalise them"""
+    batch = staging[:n].to(DEVICE, non_blocking=True)
+    # NHWC BGR uint8 -> NCHW RGB float in [0, 1]
+    return batch.permute(0, 3, 1, 2).flip(1).float().div_(255)
+
+
+@torch.inference_mode()
+def fast_predict_top1(batch: torch.Tensor):
+    """
+    Forward pass + NMS on a preprocessed batch, without building Results objects.
+    Returns one (N, 6) tensor [x1, y1, x2, y2, conf, cls] per image, N <= 1.
+    """
+    preds = backend(batch.half() if backend.fp16 else batch)
+    return ops.non_max_suppression(preds, conf_thres=0.25, iou_thres=0.45, max_det=1)
+
+
+def predict_batch(imgs):
+    """
+    Returns, per image, (class name, confidence) of the top detection, None if
+    nothing was detected, or the exception raised while preprocessing it
+    """
+    outputs = [None] * len(imgs)
+
+    # Letterbox each frame on its own so one bad image only fails its own request
+    staged = []
+    for i, img in enumerate(imgs):
+        try:
+            letterbox_into(img, staging_np[len(staged)])
+            staged.append(i)
+        except Exception as e:
+            outputs[i] = e
+    if not staged:
+        return outputs
+
+    dets = fast_predict_top1(staged_batch(len(staged)))
+    # Single device-to-host copy for the whole batch: [conf, cls] per image,
+    # with cls = -1 marking images without a detection
+    top = torch.stack(
+        [d[0, 4:6] if len(d) else d.new_tensor([0.0, -1.0]) for d in dets]
+    ).tolist()
+    for i, (confidence, cls_id) in zip(staged, top):
+        if cls_id >= 0:
+            outputs[i] = (NAME_TABLE[int(cls_id)], confidence)
+    return outputs
+
+
+def setup_backend():
+    """
+    Configure Ultralytics' predictor once (device, fp16, AutoBackend) and return
+    its backend. Serving then calls the backend directly instead of
+    model.predict(), which re-checks arguments and rebuilds its data pipeline
+    on every call.
+    """
+    model.predict(
+        np.zeros((IMGSZ, IMGSZ, 3), np.uint8), imgsz=IMGSZ, conf=0.25, verbose=False
+    )
+    return model.predictor.model
+
+
+def compile_model():
+    """
+    torch.compile the underlying network; reduce-overhead captures CUDA graphs.
+    Falls back to eager if compilation fails (e.g. no inductor/Triton backend).
+    """
+    if not backend.pt:
+        # TensorRT engines are already compiled
+        return
+    eager = backend.model
+    backend.model = torch.compile(eager, mode="reduce-overhead")
+    try:
+        # Compilation is lazy, so failures surface during warmup. Sweep every
+        # batch size detect_loop can produce so no graph is captured on a live request
+        batch_sizes = range(1, MAX_BATCH_SIZE + 1)
+        INFERENCE_EXECUTOR.submit(warmup_model, batch_sizes).result()
+    except Exception as e:
+        print(f"⚠️  torch.compile failed, serving eager model: {e}")
+        backend.model = eager
+        torch._dynamo.reset()
+
+
+def warmup_model(batch_sizes=None):
+    """Run dummy batches so kernels and the CUDA memory pool are set up before traffic"""
+    dummy = np.zeros((480, 640, 3), np.uint8)
+    for batch_size in batch_sizes or sorted({1, MAX_BATCH_SIZE}):
+        for _ in range(3):
+            predict_batch([dummy] * batch_size)
+
+
 print("🚀 Loading YOLO model into RAM...")
 print(f"   Model path: {MODEL_PATH}")
-model = YOLO(MODEL_PATH)
+model = load_model(MODEL_PATH)
+# Tuple indexed by class id, avoids a dict lookup per detection
+NAME_TABLE = tuple(model.names[i] for i in range(len(model.names)))
+
+# All inference runs on one dedicated thread: the model is loaded once per
+# process and GPU work is serialised behind the batching queue. Warmup runs
+# on the same thread so captured CUDA graphs are reused when serving.
+INFERENCE_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="inference")
+# Image decoding is CPU work (cv2 releases the GIL), kept off both the event
+# loop and the inference thread
+DECODE_EXECUTOR = ThreadPoolExecutor(
+    max_workers=min(4, os.cpu_count() or 1), thread_name_prefix="decode"
+)
+
+backend = INFERENCE_EXECUTOR.submit(setup_backend).result()
+
+print("🔥 Warming up model...")
+INFERENCE_EXECUTOR.submit(warmup_model).result()
+if USE_TORCH_COMPILE:
+    # Compile after the first warmup, then warm up again so graph capture
+    # happens before the first user request
+    print("🔧 Compiling model with torch.compile...")
+    compile_model()
 print("✅ Model loaded and ready!")
 print(f"   Classes: {list(model.names.values())}")
+if torch.cuda.is_available():
+    # Deliberately no empty_cache() here: the cached blocks are the warm pool
+    reserved_mb = torch.cuda.memory_reserved() / 2**20
+    print(f"   CUDA memory reserved: {reserved_mb:.0f} MB")
+
+
+# Shared-memory ring for clients on the same host (SHM_RING=1): raw BGR frames
+# are written into one of SHM_SLOTS slots and only the slot index is posted,
+# skipping JPEG encode/decode and the HTTP body. The server owns the segment.
+SHM_RING = os.getenv("SHM_RING", "0") == "1"
+SHM_NAME = os.getenv("SHM_NAME", "camera_ring")
+SHM_SLOTS = 8
+SHM_FRAME_SHAPE = (480, 640, 3)
 
 
 class DetectionRequest(BaseModel):
     image: str  # base64 encoded image
 
 
+class ShmDetectionRequest(BaseModel):
+    slot: int = Field(ge=0, lt=SHM_SLOTS)  # index into the shared-memory frame ring
+
+
+def decode_base64(data: str) -> bytes:
+    """Decode a base64 string, stripping an optional data URL prefix"""
+    # find() instead of split() avoids building a list of string copies;
+    # pybase64 uses the SIMD-accelerated libbase64 backend
+    idx = data.find(",")
+    return pybase64.b64decode(data if idx < 0 else data[idx + 1 :], validate=False)
+
+
+def decode_image(img_data: bytes):
+    """Decode encoded image bytes (JPEG/PNG) into a BGR numpy array, or None"""
+    return cv2.imdecode(np.frombuffer(img_data, np.uint8), cv2.IMREAD_COLOR)
+
+
+async def enqueue_and_wait(q: asyncio.Queue, img: np.ndarray):
+    """Queue an image for the batch consumer and wait for its result"""
+    fut = asyncio.get_running_loop().create_future()
+    await q.put((img, fut))
+    return await fut
+
+
+async def detect_loop(q: asyncio.Queue):
+    """Drain the queue into batches and run one predict_batch (backend forward + NMS) per batch"""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await q.get()]
+
+        # Collect whatever else arrives within the batching window
+        deadline = loop.time() + BATCH_WINDOW_S
+        while len(batch) < MAX_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(q.get(), timeout=timeout))
+            except asyncio.TimeoutError:
+                break
+
+        imgs = [img for img, _ in batch]
+        try:
+            results = await loop.run_in_executor(
+                INFERENCE_EXECUTOR, predict_batch, imgs
+            )
+        except Exception as e:
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            continue
+
+        for (_, fut), result in zip(batch, results):
+            if fut.done():
+                continue
+            if isinstance(result, Exception):
+                fut.set_exception(result)
+            else:
+                fut.set_result(result)
+
+
+@app.on_event("startup")
+async def start_detect_loop():
+    app.detect_q = asyncio.Queue()
+    app.detect_task = asyncio.create_task(detect_loop(app.detect_q))
+
+
+@app.on_event("shutdown")
+async def stop_detect_loop():
+    # Registered before close_shm_ring so the loop drops its last batch first
+    app.detect_task.cancel()
+    try:
+        await app.detect_task
+    except asyncio.CancelledError:
+        pass
+
+
+@app.on_event("startup")
+async def open_shm_ring():
+    app.shm = None
+    app.shm_owner = False
+    if not SHM_RING:
+        return
+    size = SHM_SLOTS * int(np.prod(SHM_FRAME_SHAPE))
+    try:
+        app.shm = shared_memory.SharedMemory(name=SHM_NAME, create=True, size=size)
+        app.shm_owner = True
+    except FileExistsError:
+        # Left over from a run that did not shut down cleanly, or in use by
+        # another server on this host: reuse it only if the layout matches
+        app.shm = shared_memory.SharedMemory(name=SHM_NAME)
+        if app.shm.size < size:
+            found = app.shm.size
+            app.shm.close()
+            app.shm = None
+            raise RuntimeError(
+                f"Shared memory /{SHM_NAME} already exists with {found} bytes, "
+                f"expected {size}; remove it or set SHM_NAME to another name"
+            )
+    app.shm_frames = np.ndarray(
+        (SHM_SLOTS, *SHM_FRAME_SHAPE), dtype=np.uint8, buffer=app.shm.buf
+    )
+    print(f"   Shared-memory ring: /{SHM_NAME} ({SHM_SLOTS} x {SHM_FRAME_SHAPE})")
+
+
+@app.on_event("shutdown")
+async def close_shm_ring():
+    if app.shm is not None:
+        app.shm_frames = None
+        try:
+            app.shm.close()
+        finally:
+            # Only remove a segment this server created
+            if app.shm_owner:
+                app.shm.unlink()
+
+
 @app.get("/")
 async def root():
     return {"status": "running", "model_path": MODEL_PATH, "detections": DETECTIONS}
@@ -58,6 +445,32 @@ async def health():
     return {"status": "healthy"}
 
 
+async def run_detection(img_data: bytes) -> dict:
+    """Decode an encoded image and return the top detection as a response dict"""
+    loop = asyncio.get_running_loop()
+    img = await loop.run_in_executor(DECODE_EXECUTOR, decode_image, img_data)
+
+    if img is None:
+        return {
+            "error": "Failed to decode image",
+            "detection": "no_tongue",
+            "confidence": 0.0,
+        }
+
+    # Run YOLO inference (batched with concurrent requests)
+    return format_detection(await enqueue_and_wait(app.detect_q, img))
+
+
+def format_detection(top) -> dict:
+    # No detections
+    if top is None:
+        return {"detection": "no_tongue", "confidence": 1.0}
+
+    # Highest confidence detection (NMS keeps max_det=1)
+    detection, confidence = top
+    return {"detection": detection, "confidence": confidence}
+
+
 @app.post("/detect")
 async def detect(req: DetectionRequest):
     """
@@ -72,35 +485,123 @@ async def detect(req: DetectionRequest):
     """
     try:
         # Decode base64 image
-        img_data = base64.b64decode(
-            req.image.split(",")[1] if "," in req.image else req.image
-        )
-        nparr = np.frombuffer(img_data, np.uint8)
-        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        return await run_detection(decode_base64(req.image))
+
+    except Exception as e:
+        return {"error": str(e), "detection": "no_tongue", "confidence": 0.0}
+
+
+@app.post("/detect_raw")
+async def detect_raw(request: Request):
+    """
+    Detect tongue position from raw image bytes (no base64/JSON overhead)
+
+    Request:
+        body: JPEG/PNG bytes (Content-Type: image/jpeg or application/octet-stream)
+
+    Response:
+        same as /detect
+    """
+    try:
+        return await run_detection(await request.body())
+
+    except Exception as e:
+        return {"error": str(e), "detection": "no_tongue", "confidence": 0.0}
 
-        if img is None:
-            return {
-                "error": "Failed to decode image",
-                "detection": "no_tongue",
-                "confidence": 0.0,
-            }
 
-        # Run YOLO inference
-        results = model.predict(img, conf=0.25, verbose=False)
+def is_loopback(host) -> bool:
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except (TypeError, ValueError):
+        return False
+
 
-        # No detections
-        if len(results[0].boxes) == 0:
-            return {"detection": "no_tongue", "confidence": 1.0}
+@app.post("/detect_shm")
+async def detect_shm(req: ShmDetectionRequest, request: Request):
+    """
+    Detect tongue position from a frame in the shared-memory ring (same-host clients only)
 
-        # Get highest confidence detection
-        box = results[0].boxes[0]
-        cls_id = int(box.cls[0])
-        confidence = float(box.conf[0])
+    Request (from a loopback address):
+        header X-Shm-Client: 1
+        slot: ring slot (0 to SHM_SLOTS - 1) holding a 480x640 BGR frame
 
-        return {"detection": model.names[cls_id], "confidence": confidence}
+    Response:
+        same as /detect
+    """
+    if (
+        request.headers.get("x-shm-client") != "1"
+        or app.shm is None
+        or not is_loopback(request.client.host if request.client else None)
+    ):
+        return {
+            "error": "Shared-memory ring not available",
+            "detection": "no_tongue",
+            "confidence": 0.0,
+        }
+    try:
+        # Copy out of shared memory so the client can reuse the slot (e.g. after
+        # a timeout) without changing a frame mid-inference, and so no view
+        # keeps the segment exported at shutdown
+        frame = app.shm_frames[req.slot].copy()
+        return format_detection(await enqueue_and_wait(app.detect_q, frame))
 
     except Exception as e:
         return {"error": str(e), "detection": "no_tongue", "confidence": 0.0}
 
 
-# Run with: uvicorn server:app --reload --port 8000
+@app.websocket("/detect_ws")
+async def detect_ws(ws: WebSocket):
+    """
+    Stream frames over a persistent WebSocket
+
+    Request (binary message per frame):
+        4-byte big-endian frame id followed by JPEG/PNG bytes.
+        Text messages or shorter payloads close the socket with code 1003.
+
+    Response (JSON message per frame):
+        same as /detect, plus "id" echoing the frame id.
+        Frames are processed concurrently (and batched), so replies can arrive out of order.
+        At most MAX_BATCH_SIZE frames per connection are in flight; further frames
+        are not read until a reply has been sent.
+    """
+    await ws.accept()
+    pending = set()
+    # Per-connection cap on frames in flight; reading pauses once it is reached
+    in_flight = asyncio.Semaphore(MAX_BATCH_SIZE)
+
+    async def handle(frame_id: int, img_data: memoryview):
+        try:
+            try:
+                result = await run_detection(img_data)
+            except Exception as e:
+                result = {"error": str(e), "detection": "no_tongue", "confidence": 0.0}
+            result["id"] = frame_id
+            await ws.send_json(result)
+        except (WebSocketDisconnect, RuntimeError):
+            # Socket closed while this frame was in flight
+            pass
+        finally:
+            in_flight.release()
+
+    try:
+        while True:
+            await in_flight.acquire()
+            message = await ws.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            data = message.get("bytes")
+            if data is None or len(data) < 5:
+                # Text frames and payloads without an id + image are unsupported
+                await ws.close(code=1003)
+                break
+            frame_id = int.from_bytes(data[:4], "big")
+            task = asyncio.create_task(handle(frame_id, memoryview(data)[4:]))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+# Run with: uvicorn server:app --workers 1 --loop uvloop --http httptools --port 8000
+# Keep a single worker: each extra worker loads its own copy of the model into VRAM
@@ -1,91 +1,282 @@
+import argparse
+import asyncio
+import json
+import os
 import cv2
+import numpy as np
 import requests
-import base64
 import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
 
-# Start webcam
-cap = cv2.VideoCapture(0)
-cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
-cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
-
-if not cap.isOpened():
-    print("ERROR: Could not open camera")
-    exit(1)
-
-print("Camera opened successfully!")
-print("Starting live detection... Press 'q' to quit")
-print("-" * 50)
-
-# Wait for camera to warm up
-print("Warming up camera...")
-for _ in range(10):
-    cap.read()  # Discard first few frames
-time.sleep(0.5)
-
-frame_count = 0
-fps_time = time.time()
-fps = 0
-retry_count = 0
-
-while True:
-    ret, frame = cap.read()
-    if not ret:
-        retry_count += 1
-        if retry_count > 30:
-            print("\nCamera lost, exiting...")
-            break
+WINDOW_NAME = 'YOLO Live Test (Press Q to quit)'
+JPEG_PARAMS = [cv2.IMWRITE_JPEG_QUALITY, 80]
+
+# Must match the server's shared-memory ring (server started with SHM_RING=1)
+SHM_NAME = os.getenv("SHM_NAME", "camera_ring")
+SHM_SLOTS = 8
+SHM_FRAME_SHAPE = (480, 640, 3)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Live webcam test for the model server")
+    parser.add_argument(
+        "--transport",
+        choices=["ws", "http", "shm"],
+        default="ws",
+        help=(
+            "ws: pipelined frames over /detect_ws; http: one POST per frame to "
+            "/detect_raw; shm: raw frames via shared memory (same host only)"
+        ),
+    )
+    parser.add_argument(
+        "--host", type=str, default="localhost:8000", help="Model server host:port"
+    )
+    parser.add_argument(
+        "--max_in_flight",
+        type=int,
+        default=3,
+        help="Max frames awaiting a result (ws transport only)",
+    )
+    return parser.parse_args()
+
+
+def open_camera() -> cv2.VideoCapture:
+    cap = cv2.VideoCapture(0)
+    cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
+    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
+
+    if not cap.isOpened():
+        print("ERROR: Could not open camera")
+        exit(1)
+
+    print("Camera opened successfully!")
+    print("Starting live detection... Press 'q' to quit")
+    print("-" * 50)
+
+    # Wait for camera to warm up
+    print("Warming up camera...")
+    for _ in range(10):
+        cap.read()  # Discard first few frames
+    time.sleep(0.5)
+    return cap
+
+
+def read_frame(cap: cv2.VideoCapture):
+    """Read a frame, retrying up to 30 times; returns None if the camera is lost"""
+    for retry_count in range(1, 31):
+        ret, frame = cap.read()
+        if ret:
+            return frame
         print(f"Warning: Failed to read frame ({retry_count}/30), retrying...")
         time.sleep(0.1)
-        continue
+    print("\nCamera lost, exiting...")
+    return None
+
+
+def draw_result(frame, result: dict, fps: int):
+    detection = result.get('detection', 'unknown')
+    confidence = result.get('confidence', 0)
+
+    # Display on frame
+    color = (0, 255, 0) if confidence > 0.7 else (0, 255, 255)
+    cv2.putText(frame, f"Detection: {detection}", (10, 30),
+                cv2.FONT_HERSHEY_SIMPLEX, 0.7, color, 2)
+    cv2.putText(frame, f"Confidence: {confidence:.2%}", (10, 60),
+                cv2.FONT_HERSHEY_SIMPLEX, 0.7, color, 2)
+    cv2.putText(frame, f"FPS: {fps}", (10, 90),
+                cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 255), 2)
+
+    # Print to console
+    print(f"\r{detection:15s} | {confidence:.2%}", end='')
+
+
+def draw_error(frame, error: Exception):
+    cv2.putText(frame, f"Error: {str(error)[:30]}", (10, 30),
+                cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 1)
+
+
+class FpsCounter:
+    def __init__(self):
+        self.fps = 0
+        self.frame_count = 0
+        self.fps_time = time.time()
+
+    def tick(self):
+        self.frame_count += 1
+        if time.time() - self.fps_time >= 1.0:
+            self.fps = self.frame_count
+            self.frame_count = 0
+            self.fps_time = time.time()
+
+
+def show(frame) -> bool:
+    """Show a frame; returns False once 'q' is pressed"""
+    cv2.imshow(WINDOW_NAME, frame)
+    return not (cv2.waitKey(1) & 0xFF == ord('q'))
+
+
+def run_http(cap: cv2.VideoCapture, host: str):
+    """One synchronous POST per frame to /detect_raw"""
+    # Reuse one keep-alive connection instead of a new TCP handshake per frame
+    session = requests.Session()
+    session.headers['Connection'] = 'keep-alive'
+
+    # JPEG encoding runs in the background: frame N is encoded while frame N-1 is
+    # being sent and displayed
+    encode_pool = ThreadPoolExecutor(2)
+    pending = None  # (frame, encode future) waiting to be sent
+    counter = FpsCounter()
+
+    while True:
+        frame = read_frame(cap)
+        if frame is None:
+            break
+
+        # Start encoding this frame, then send/show the previously encoded one
+        encode_fut = encode_pool.submit(cv2.imencode, '.jpg', frame, JPEG_PARAMS)
+        if pending is None:
+            pending = (frame, encode_fut)
+            continue
+        (frame, prev_fut), pending = pending, (frame, encode_fut)
+        _, buffer = prev_fut.result()
+
+        try:
+            # Send raw JPEG bytes to FastAPI (skips base64 + JSON on both ends)
+            response = session.post(
+                f'http://{host}/detect_raw',
+                data=buffer.tobytes(),
+                headers={'Content-Type': 'image/jpeg'},
+                timeout=1
+            )
+            draw_result(frame, response.json(), counter.fps)
+        except Exception as e:
+            draw_error(frame, e)
+
+        counter.tick()
+        if not show(frame):
+            break
+
+    encode_pool.shutdown(cancel_futures=True)
+    session.close()
 
-    retry_count = 0  # Reset on successful read
 
-    # Encode frame to base64
-    _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 80])
-    img_b64 = base64.b64encode(buffer).decode('utf-8')
-    img_data_url = f"data:image/jpeg;base64,{img_b64}"
+def run_shm(cap: cv2.VideoCapture, host: str):
+    """Write raw frames into the server's shared-memory ring and post only the slot"""
+    shm = shared_memory.SharedMemory(name=SHM_NAME)
+    if os.name == "posix":
+        # The server owns the segment; stop our resource tracker unlinking it on exit
+        resource_tracker.unregister(shm._name, "shared_memory")
+    ring = np.ndarray((SHM_SLOTS, *SHM_FRAME_SHAPE), dtype=np.uint8, buffer=shm.buf)
+
+    session = requests.Session()
+    session.headers['X-Shm-Client'] = '1'
+    counter = FpsCounter()
+    height, width = SHM_FRAME_SHAPE[:2]
+    slot = 0
+
+    while True:
+        frame = read_frame(cap)
+        if frame is None:
+            break
+        if frame.shape != SHM_FRAME_SHAPE:
+            frame = cv2.resize(frame, (width, height))
+
+        # Requests are synchronous, so the server is done with a slot before it is reused
+        ring[slot] = frame
+        try:
+            response = session.post(
+                f'http://{host}/detect_shm', json={'slot': slot}, timeout=1
+            )
+            draw_result(frame, response.json(), counter.fps)
+        except Exception as e:
+            draw_error(frame, e)
+        slot = (slot + 1) % SHM_SLOTS
+
+        counter.tick()
+        if not show(frame):
+            break
 
+    session.close()
+    del ring
+    shm.close()
+
+
+async def run_ws(cap: cv2.VideoCapture, host: str, max_in_flight: int):
+    """
+    Pipelined streaming over /detect_ws: a sender keeps up to max_in_flight
+    frames at the server while a receiver draws results as they come back,
+    so capture, encode, network and inference overlap.
+    """
+    import websockets
+
+    loop = asyncio.get_running_loop()
+    encode_pool = ThreadPoolExecutor(2)
+    in_flight = asyncio.Semaphore(max_in_flight)
+    frames = {}  # frame id -> frame awaiting its result
+    counter = FpsCounter()
+
+    async with websockets.connect(f'ws://{host}/detect_ws', max_size=None) as ws:
+
+        async def sender():
+            frame_id = 0
+            while True:
+                await in_flight.acquire()
+                frame = await asyncio.to_thread(read_frame, cap)
+                if frame is None:
+                    return
+                _, buffer = await loop.run_in_executor(
+                    encode_pool, cv2.imencode, '.jpg', frame, JPEG_PARAMS
+                )
+                frames[frame_id] = frame
+                # Tag each frame with its id so out-of-order replies can be matched
+                await ws.send(frame_id.to_bytes(4, 'big') + buffer.tobytes())
+                frame_id = (frame_id + 1) % 2**32
+
+        async def receiver():
+            last_shown = -1
+            async for message in ws:
+                result = json.loads(message)
+                frame_id = result.get('id')
+                frame = frames.pop(frame_id, None)
+                in_flight.release()
+                # Skip frames overtaken by a newer result
+                if frame is None or frame_id < last_shown:
+                    continue
+                last_shown = frame_id
+
+                draw_result(frame, result, counter.fps)
+                counter.tick()
+                if not show(frame):
+                    return
+
+        send_task = asyncio.create_task(sender())
+        recv_task = asyncio.create_task(receiver())
+        try:
+            await asyncio.wait(
+                {send_task, recv_task}, return_when=asyncio.FIRST_COMPLETED
+            )
+        finally:
+            send_task.cancel()
+            recv_task.cancel()
+            encode_pool.shutdown(cancel_futures=True)
+
+
+def main() -> None:
+    args = parse_args()
+    cap = open_camera()
     try:
-        # Send to FastAPI
-        response = requests.post(
-            'http://localhost:8000/detect',
-            json={'image': img_data_url},
-            timeout=1
-        )
-
-        result = response.json()
-        detection = result.get('detection', 'unknown')
-        confidence = result.get('confidence', 0)
-
-        # Display on frame
-        color = (0, 255, 0) if confidence > 0.7 else (0, 255, 255)
-        cv2.putText(frame, f"Detection: {detection}", (10, 30),
-                    cv2.FONT_HERSHEY_SIMPLEX, 0.7, color, 2)
-        cv2.putText(frame, f"Confidence: {confidence:.2%}", (10, 60),
-                    cv2.FONT_HERSHEY_SIMPLEX, 0.7, color, 2)
-        cv2.putText(frame, f"FPS: {fps}", (10, 90),
-                    cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 255), 2)
-
-        # Print to console
-        print(f"\r{detection:15s} | {confidence:.2%}", end='')
-
-    except Exception as e:
-        cv2.putText(frame, f"Error: {str(e)[:30]}", (10, 30),
-                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 1)
-
-    # Calculate FPS
-    frame_count += 1
-    if time.time() - fps_time >= 1.0:
-        fps = frame_count
-        frame_count = 0
-        fps_time = time.time()
-
-    # Show frame
-    cv2.imshow('YOLO Live Test (Press Q to quit)', frame)
-
-    if cv2.waitKey(1) & 0xFF == ord('q'):
-        break
-
-cap.release()
-cv2.destroyAllWindows()
-print("\nStopped.")
+        if args.transport == "ws":
+            asyncio.run(run_ws(cap, args.host, args.max_in_flight))
+        elif args.transport == "shm":
+            run_shm(cap, args.host)
+        else:
+            run_http(cap, args.host)
+    finally:
+        cap.release()
+        cv2.destroyAllWindows()
+        print("\nStopped.")
+
+
+if __name__ == "__main__":
+    main()
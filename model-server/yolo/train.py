@@ -1,6 +1,7 @@
 import argparse
 import os
 import random
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import List
 
@@ -12,8 +13,8 @@ from ultralytics import YOLO
 def read_class_names(classes_file: Path) -> List[str]:
     if not classes_file.exists():
         raise FileNotFoundError(f"Classes file not found: {classes_file}")
-    with classes_file.open("r", encoding="utf-8") as f:
-        names = [line.strip() for line in f.readlines() if line.strip()]
+    lines = classes_file.read_text(encoding="utf-8").splitlines()
+    names = [name for name in (line.strip() for line in lines) if name]
     if not names:
         raise ValueError(f"No classes found in {classes_file}")
     return names
@@ -36,12 +37,17 @@ def collect_images(images_dir: Path) -> List[Path]:
 
 
 def filter_images_with_labels(image_paths: List[Path], labels_dir: Path) -> List[Path]:
-    filtered = []
-    for img_path in image_paths:
-        label_path = labels_dir / f"{img_path.stem}.txt"
-        if label_path.exists():
-            filtered.append(img_path)
-    return filtered
+    # One directory scan instead of a stat() per image
+    with os.scandir(labels_dir) as entries:
+        label_stems = {e.name[:-4] for e in entries if e.name.endswith(".txt")}
+    return [p for p in image_paths if p.stem in label_stems]
+
+
+def join_resolved_paths(paths: List[Path]) -> str:
+    # Path.resolve() hits the filesystem, so resolve in parallel
+    with ThreadPoolExecutor() as pool:
+        resolved = list(pool.map(lambda p: str(p.resolve()), paths))
+    return "".join(f"{p}\n" for p in resolved)
 
 
 def write_split_files(
@@ -55,12 +61,8 @@ def write_split_files(
 
     train_txt = split_dir / "train.txt"
     val_txt = split_dir / "val.txt"
-    with train_txt.open("w", encoding="utf-8") as f:
-        for p in train_images:
-            f.write(str(p.resolve()) + "\n")
-    with val_txt.open("w", encoding="utf-8") as f:
-        for p in val_images:
-            f.write(str(p.resolve()) + "\n")
+    train_txt.write_text(join_resolved_paths(train_images), encoding="utf-8")
+    val_txt.write_text(join_resolved_paths(val_images), encoding="utf-8")
     return train_txt, val_txt
 
 